@@ -1,56 +1,221 @@
 ## This script performs node voltage analysis on a SPICE file
 ## to generate its transfer function 
 
+import argparse
+import functools
+import hashlib
+import itertools
+import numpy as np
+import os
+import pathlib
+import pickle
+import re
+import symengine as se
 import sympy as sp
 import sys
+import tempfile
+
+# Lines starting with any of these characters are
+# comments or dot commands (.backanno, .end, ...)
+TO_IGNORE = frozenset({"*", "."})
+
+# Netlists with at least this many lines are split into
+# chunks of this many lines which are stamped in parallel
+STAMP_CHUNK_SIZE = 10000
+
+# Directory where solved circuits are cached between runs, keyed by
+# the SHA-256 of their netlist's topology. The cache is unpickled, so it lives in
+# the user's own cache directory rather than next to the netlist,
+# where a netlist could be shipped together with a malicious entry.
+if os.name == "nt":
+    CACHE_DIR = pathlib.Path(os.environ.get("LOCALAPPDATA") or pathlib.Path.home()) / "tfcalc"
+else:
+    CACHE_DIR = pathlib.Path(os.environ.get("XDG_CACHE_HOME") or pathlib.Path.home() / ".cache") / "tfcalc"
+
+# Bumped whenever the cached circuit state changes, so entries
+# written by older versions of this script are ignored
+CACHE_VERSION = 4
+
+# Multiplier applied to a component value for each SPICE suffix
+SUFFIX_MULTIPLIERS = {"t": 1e12,
+                      "g": 1e9,
+                      "meg": 1e6,
+                      "k": 1e3,
+                      "": 1.0,
+                      "m": 1e-3,
+                      "u": 1e-6,
+                      "n": 1e-9,
+                      "p": 1e-12,
+                      "f": 1e-15,
+                      "mil": 25.4e-6}
+
+# A component value is a number, an optional suffix and an
+# optional unit (henries, farads, ohms, volts or amps)
+VALUE_PATTERN = re.compile(r"^([-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+)(?:e[-+]?[0-9]+)?)"
+                           r"(meg|mil|[tgkmunpf]?)[hfrva]?$")
+
+# The circuit is described by its modified nodal analysis (MNA)
+# system A * x = b, where x holds the unknowns: the voltage of every
+# node other than ground and the current through every voltage source.
+# Each row of A is identified by the unknown it introduced: a node's
+# row is its KCL equation (sum of currents flowing OUT of the node)
+# and a voltage source's row is its voltage constraint.
+
+# Each entry in stamps is of the form
+# key: (row, column) of A, given as the unknowns (SymEngine variables)
+#      identifying that row and column
+# value: running sum (SymEngine expression) of the terms stamped
+#        into the entry
+stamps = {}
+
+# Each entry in excitations is of the form
+# key: row of b, given as the unknown identifying that row
+# value: running sum (SymEngine expression) of the terms stamped
+#        into the entry
+excitations = {}
 
-filename = sys.argv[1]
-input_var = sys.argv[2]
-output_var = sys.argv[3]
+equations = []
 
-sp.init_printing()
+unknowns = []
 
-TO_IGNORE = ["*", \
-             ".backanno", \
-             ".end"]
+# Each entry in unknown_index is of the form
+# key: an unknown (SymEngine variable)
+# value: its position in unknowns
+unknown_index = {}
 
-# Each entry in node_list is of the form
-# key: a string representing the node's name
-# value: list of currents (SymPy variables), where positive current
-#        indicates current flowing INTO the node
-node_list = {}
+values = {}
 
-equations = []
+# Each entry in voltage_sources is of the form
+# key: the current through a voltage source (SymEngine variable)
+# value: tuple of the source's positive node voltage, negative
+#        node voltage and value (SymEngine variables)
+voltage_sources = {}
 
-unknowns = []
+# Each entry in fixed_voltages is of the form
+# key: the voltage of a node connected to ground through a
+#      voltage source (SymEngine variable)
+# value: tuple of the node's voltage in terms of the source's value
+#        and the source's current (SymEngine variable)
+fixed_voltages = {}
 
-values = {}
+# Unknowns that are solved for in the MNA system, which excludes the
+# fixed node voltages and the currents of their voltage sources
+system_unknowns = []
 
 # Laplace variable
-s = sp.symbols("s")
+s = se.symbols("s")
+
+# Caches of the node voltage symbols and component admittances,
+# so each is only constructed once no matter how many
+# components refer to it
+_vsym = {}
+_ysym = {}
+
+def reset_circuit():
+    stamps.clear()
+    excitations.clear()
+    equations.clear()
+    unknowns.clear()
+    unknown_index.clear()
+    values.clear()
+    voltage_sources.clear()
+    fixed_voltages.clear()
+    system_unknowns.clear()
+
+def add_unknown(unknown):
+    if unknown not in unknown_index.keys():
+        unknown_index[unknown] = len(unknowns)
+        unknowns.append(unknown)
+
+def node_voltage(node):
+    # Ground is the reference node, so it has no unknown voltage
+    # and no row or column in the MNA system
+    if node == "0":
+        return 0
+
+    if node not in _vsym.keys():
+        _vsym[node] = se.symbols("V" + node)
+
+    Vnode = _vsym[node]
+    add_unknown(Vnode)
+    return Vnode
+
+def admittance(name):
+    # Admittances are built directly, rather than as the
+    # reciprocal of an impedance, so a capacitor stamps the
+    # single product s*C instead of 1/(1/(s*C))
+    if name not in _ysym.keys():
+        component_type = name[0]
+        symbol = se.symbols(name)
+
+        if component_type == "R":
+            _ysym[name] = 1 / symbol
+        elif component_type == "C":
+            _ysym[name] = s * symbol
+        elif component_type == "L":
+            _ysym[name] = 1 / (s * symbol)
+
+    return _ysym[name]
+
+def add_stamp(row, column, term):
+    if row == 0 or column == 0:
+        return
 
-def add_positive_current_to_node(node, current):
-    if node in node_list.keys():
-        node_list[node].append(current)
-        unknowns.append(sp.symbols("V" + node))
+    # Terms are summed as they are stamped, so equal terms
+    # combine (or cancel) immediately
+    if (row, column) in stamps.keys():
+        stamps[(row, column)] += term
     else:
-        node_list[node] = [current]
+        stamps[(row, column)] = se.S.Zero + term
+
+def add_excitation(row, term):
+    if row == 0:
+        return
 
-def add_negative_current_to_node(node, current):
-    if node in node_list.keys():
-        node_list[node].append(-1 * current)
-        unknowns.append(sp.symbols("V" + node))
+    if row in excitations.keys():
+        excitations[row] += term
     else:
-        node_list[node] = [-1 * current]
+        excitations[row] = se.S.Zero + term
+
+def add_admittance(Vnode_1, Vnode_2, Y):
+    # The current (Vnode_1 - Vnode_2) * Y flows OUT of node 1
+    # and INTO node 2
+    add_stamp(Vnode_1, Vnode_1, Y)
+    add_stamp(Vnode_1, Vnode_2, -1 * Y)
+    add_stamp(Vnode_2, Vnode_2, Y)
+    add_stamp(Vnode_2, Vnode_1, -1 * Y)
 
 def add_voltage_source(Vnode_1, Vnode_2, Vsrc_symbol, Vsrc_current):
+    add_unknown(Vsrc_current)
+    voltage_sources[Vsrc_current] = (Vnode_1, Vnode_2, Vsrc_symbol)
+
+    # The source current flows OUT of node 1 and INTO node 2
+    add_stamp(Vnode_1, Vsrc_current, 1)
+    add_stamp(Vnode_2, Vsrc_current, -1)
+
     # A voltage source imposes the constraint that the difference
     # between its positive and negative nodes is equal to its value
-    voltage_constraint = sp.Eq(Vsrc_symbol, Vnode_1 - Vnode_2)
-    equations.append(voltage_constraint)
-    unknowns.append(Vsrc_current)
+    add_stamp(Vsrc_current, Vnode_1, 1)
+    add_stamp(Vsrc_current, Vnode_2, -1)
+    add_excitation(Vsrc_current, Vsrc_symbol)
+
+def add_current_source(Vnode_1, Vnode_2, Isrc_symbol):
+    # The source current is known, so it moves to the right hand
+    # side of the KCL equations of the nodes it flows OUT of
+    # (node 1) and INTO (node 2)
+    add_excitation(Vnode_1, -1 * Isrc_symbol)
+    add_excitation(Vnode_2, Isrc_symbol)
 
 def add_component(component, value):
+    parsed_val = parse_value(value)
+
+    if parsed_val is None:
+        raise ValueError("Could not interpret value " + value + " for component " + component)
+
+    values[component] = parsed_val
+
+@functools.lru_cache(maxsize=None)
+def parse_value(value):
 
     value = value.lower()
 
@@ -58,167 +223,541 @@ def add_component(component, value):
     # with the letter "u"
     value = value.replace("µ", "u")
 
-    value = value.strip("h")
-    value = value.strip("f")
-    value = value.strip("r")
-    value = value.strip("v")
-    value = value.strip("a")
-    
-    parsed_val = 0
-
-    if value.isnumeric():
-        parsed_val = int(value)
-    elif value.endswith("meg"):
-        parsed_val = int(value[:-3]) * 10**6
-    elif value.endswith("mil"):
-        parsed_val = int(value[:-3]) * 25.4 * 10**-6
-    elif value.endswith("t"):
-        parsed_val = int(value[:-1]) * 10**12
-    elif value.endswith("g"):
-        parsed_val = int(value[:-1])* 10**9
-    elif value.endswith("k"):
-        parsed_val = int(value[:-1]) * 10**3
-    elif value.endswith("m"):
-        parsed_val = int(value[:-1]) * 10**-3
-    elif value.endswith("u"):
-        parsed_val = int(value[:-1]) * 10**-6
-    elif value.endswith("n"):
-        parsed_val = int(value[:-1]) * 10**-9
-    elif value.endswith("p"):
-        parsed_val = int(value[:-1]) * 10**-12
-    elif value.endswith("f"):
-        parsed_val = int(value[:-1]) * 10**-15
-    else:
-        raise ValueError("Could not interpret value " + value + " for component " + component)
-    
-    values[component] = parsed_val
+    match = VALUE_PATTERN.match(value)
 
+    if match is None:
+        return None
 
-def handle_spice_line(line):
+    return float(match.group(1)) * SUFFIX_MULTIPLIERS[match.group(2)]
 
-    if line[0] in TO_IGNORE:
-        return
+
+def stamp_passive(line, Vnode_1, Vnode_2, symbol):
+    add_admittance(Vnode_1, Vnode_2, admittance(line[0]))
+
+def stamp_voltage_source(line, Vnode_1, Vnode_2, symbol):
+    I = se.symbols("I" + line[0])
+    add_voltage_source(Vnode_1, Vnode_2, symbol, I)
+
+def stamp_current_source(line, Vnode_1, Vnode_2, symbol):
+    add_current_source(Vnode_1, Vnode_2, symbol)
+
+# Each entry in STAMP_HANDLERS is of the form
+# key: the letter a component's name starts with
+# value: function that stamps that type of component into the MNA system
+STAMP_HANDLERS = {"R": stamp_passive,
+                  "C": stamp_passive,
+                  "L": stamp_passive,
+                  "V": stamp_voltage_source,
+                  "I": stamp_current_source}
+
+def handle_spice_line(line):
 
     # The direction of current flowing through any component is defined
     # as positive when it flows from the node listed first in the SPICE
     # line to the node listed as the second in the SPICE line
-    
-    component_type = line[0][0]
-
-    if component_type == "R" \
-        or component_type == "C" \
-        or component_type == "L":
-
-        name = line[0]
-        node_1 = line[1]
-        node_2 = line[2]
-        value = line[3]
-        
-        Vnode_1 = sp.symbols("V" + node_1) if node_1 != "0" else 0
-        Vnode_2 = sp.symbols("V" + node_2) if node_2 != "0" else 0
-        symbol = sp.symbols(name)
 
-        if component_type == "R":
-            Z = symbol
-        elif component_type == "C":
-            Z = 1 / (s * symbol)
-        elif component_type == "L":
-            Z = s * symbol
+    handler = STAMP_HANDLERS.get(line[0][0])
+
+    if handler is None:
+        return
 
-        I = (Vnode_1 - Vnode_2) / Z
-        
-        # This is current flowing OUT of node 1
-        # and INTO node 2, so it is defined as
-        # NEGATIVE current for node 1 and
-        # POSITIVE current for node 2
-        add_negative_current_to_node(node_1, I)
-        add_positive_current_to_node(node_2, I)
+    name = line[0]
+    node_1 = line[1]
+    node_2 = line[2]
+    value = line[3]
 
-        add_component(name, value)
+    Vnode_1 = node_voltage(node_1)
+    Vnode_2 = node_voltage(node_2)
+    symbol = se.symbols(name)
 
-    elif component_type == "V":
-        name = line[0]
-        node_1 = line[1]
-        node_2 = line[2]
-        value = line[3]
+    handler(line, Vnode_1, Vnode_2, symbol)
 
-        Vnode_1 = sp.symbols("V" + node_1) if node_1 != "0" else 0
-        Vnode_2 = sp.symbols("V" + node_2) if node_2 != "0" else 0
-        symbol = sp.symbols(name)
+    add_component(name, value)
 
-        I = sp.symbols("I" + name)
 
-        # This is current flowing OUT of node 1
-        # and INTO node 2, so it is defined as
-        # NEGATIVE current for node 1 and
-        # POSITIVE current for node 2
-        add_negative_current_to_node(node_1, I)
-        add_positive_current_to_node(node_2, I)
+def stamp_lines(lines):
+    for line in lines:
+        tokens = line.split()
+
+        if not tokens or tokens[0][0] in TO_IGNORE:
+            continue
+
+        handle_spice_line(tokens)
 
-        add_voltage_source(Vnode_1, Vnode_2, symbol, I)
+def stamp_chunk(lines):
+    # Runs in a worker process, so it stamps into that
+    # process's own copy of the circuit state and sends it back
+    reset_circuit()
+    stamp_lines(lines)
 
-        add_component(name, value)
+    return stamps, excitations, unknowns, values, voltage_sources
 
+def merge_chunk(chunk_stamps, chunk_excitations, chunk_unknowns, chunk_values,
+                chunk_voltage_sources):
+    for unknown in chunk_unknowns:
+        add_unknown(unknown)
+
+    for key, entry in chunk_stamps.items():
+        if key in stamps.keys():
+            stamps[key] += entry
+        else:
+            stamps[key] = entry
+
+    for row, entry in chunk_excitations.items():
+        if row in excitations.keys():
+            excitations[row] += entry
+        else:
+            excitations[row] = entry
 
-    elif component_type == "I":
-        name = line[0]
-        node_1 = line[1]
-        node_2 = line[2]
-        value = line[3]
+    values.update(chunk_values)
+    voltage_sources.update(chunk_voltage_sources)
 
-        I = sp.symbols("I" + name)
+def read_netlist(netlist_path):
+    netlist_bytes = pathlib.Path(netlist_path).read_bytes()
 
-        # This is current flowing OUT of node 1
-        # and INTO node 2, so it is defined as
-        # NEGATIVE current for node 1 and
-        # POSITIVE current for node 2
-        add_negative_current_to_node(node_1, I)
-        add_positive_current_to_node(node_2, I)
+    # LTspice writes netlists in the Windows code page, where
+    # the "mu" symbol is the single byte 0xB5, so anything
+    # that is not valid UTF-8 is read as Latin-1
+    try:
+        return netlist_bytes.decode("utf-8")
+    except UnicodeDecodeError:
+        return netlist_bytes.decode("latin-1")
+
+def netlist_topology(lines):
+    # The components of a netlist and the nodes they connect, without
+    # their values, which is all the symbolic solution depends on
+    topology = []
+
+    for line in lines:
+        tokens = line.split()
+
+        if not tokens or tokens[0][0] not in STAMP_HANDLERS.keys():
+            continue
+
+        topology.append(tuple(tokens[:3]))
+
+    return tuple(topology)
+
+def netlist_digest(netlist_text):
+    # Component values are left out of the digest, so a netlist
+    # that only changes a value still hits the cache
+    topology = netlist_topology(netlist_text.splitlines())
+    return hashlib.sha256(repr(topology).encode("utf-8")).hexdigest()
+
+def load_values(lines):
+    # Parses only the component values, for a circuit whose
+    # stamps were restored from the cache
+    values.clear()
+
+    for line in lines:
+        tokens = line.split()
+
+        if not tokens or tokens[0][0] not in STAMP_HANDLERS.keys():
+            continue
+
+        add_component(tokens[0], tokens[3])
+
+def load_cached_circuit(digest):
+    # Restores the circuit state saved by save_cached_circuit, apart
+    # from the component values, and returns its solutions, or None
+    # if the netlist is not cached
+    cache_path = CACHE_DIR / (digest + ".pkl")
+
+    # Anything that cannot be read back as a circuit
+    # is treated as a cache miss
+    try:
+        with open(cache_path, "rb") as cache_file:
+            circuit = pickle.load(cache_file)
+
+        if not isinstance(circuit, dict) or circuit.get("version") != CACHE_VERSION:
+            return None
+
+        reset_circuit()
+
+        stamps.update(circuit["stamps"])
+        excitations.update(circuit["excitations"])
+        equations.extend(circuit["equations"])
+        voltage_sources.update(circuit["voltage_sources"])
+
+        for unknown in circuit["unknowns"]:
+            add_unknown(unknown)
+
+        return dict(circuit["sols"])
+    except Exception:
+        reset_circuit()
+        return None
+
+def save_cached_circuit(digest, sols):
+    circuit = {"version": CACHE_VERSION,
+               "stamps": stamps,
+               "excitations": excitations,
+               "equations": equations,
+               "unknowns": unknowns,
+               "voltage_sources": voltage_sources,
+               "sols": sols}
+
+    # The cache is only an optimization, so if it cannot be
+    # written the circuit is simply not cached
+    try:
+        CACHE_DIR.mkdir(parents=True, exist_ok=True)
+
+        # The cache file is written under a temporary name and then
+        # renamed, so a concurrent run never reads a partial file
+        cache_file = tempfile.NamedTemporaryFile("wb", dir=CACHE_DIR, delete=False)
+    except OSError:
+        return
+
+    try:
+        with cache_file:
+            pickle.dump(circuit, cache_file)
+
+        os.replace(cache_file.name, CACHE_DIR / (digest + ".pkl"))
+    except Exception:
+        # Anything left under the temporary name would never be
+        # read or replaced, so it is removed
+        try:
+            os.unlink(cache_file.name)
+        except OSError:
+            pass
+
+def available_cpus():
+    # The CPUs this process may run on, which can be fewer than
+    # the machine has (e.g. in a container or under taskset)
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+
+    return os.cpu_count() or 1
+
+def load_netlist(lines):
+    reset_circuit()
+
+    lines = iter(lines)
+    chunk = list(itertools.islice(lines, STAMP_CHUNK_SIZE))
+
+    # With a single CPU there is nothing to gain from
+    # sending the stamps between processes
+    if len(chunk) < STAMP_CHUNK_SIZE or available_cpus() < 2:
+        stamp_lines(chunk)
+        stamp_lines(lines)
+        return
+
+    # Large netlists are stamped in parallel, one chunk of lines
+    # per task. Every component only touches its own entries, so
+    # the chunks are independent and are merged in netlist order
+    # to give the same unknowns as stamping serially.
+    # (Imported here to keep it out of the start up time of
+    # the usual, serial case.)
+    import concurrent.futures
+
+    with concurrent.futures.ProcessPoolExecutor() as executor:
+        futures = []
+
+        while chunk:
+            futures.append(executor.submit(stamp_chunk, chunk))
+            chunk = list(itertools.islice(lines, STAMP_CHUNK_SIZE))
+
+        for future in futures:
+            merge_chunk(*future.result())
+
+def fold_grounded_sources():
+    # A voltage source between a node and ground fixes that node's
+    # voltage, so instead of solving for the node voltage and the
+    # source current, the source's value is substituted for the node
+    # voltage. This drops the node's KCL row and the source's
+    # constraint row, along with both of their unknowns.
+    fixed_voltages.clear()
+
+    for Vsrc_current, (Vnode_1, Vnode_2, Vsrc_symbol) in voltage_sources.items():
+        if Vnode_2 == 0 and Vnode_1 != 0:
+            node, value = Vnode_1, Vsrc_symbol
+        elif Vnode_1 == 0 and Vnode_2 != 0:
+            node, value = Vnode_2, -1 * Vsrc_symbol
+        else:
+            continue
 
-        add_component(name, value)     
+        # A second source on an already fixed node stays in the
+        # MNA system
+        if node not in fixed_voltages.keys():
+            fixed_voltages[node] = (value, Vsrc_current)
 
+    folded_currents = {Vsrc_current for _, Vsrc_current in fixed_voltages.values()}
 
-def generate_KCL_equations():
-    for node in node_list.keys():
-        currents = node_list[node]
+    system_unknowns.clear()
+    system_unknowns.extend(unknown for unknown in unknowns
+                           if unknown not in fixed_voltages.keys()
+                           and unknown not in folded_currents)
 
-        # Kirchhoff's current law
-        KCL_eq = sp.Eq(sum(currents), 0)
-        equations.append(KCL_eq)
+def MNA_entries():
+    # Returns the nonzero entries of A and b after folding the
+    # grounded voltage sources, as dicts mapping each entry's
+    # (row, column) or row position to its value
+    fold_grounded_sources()
 
-def solve_equations(output_var):
-    sol = sp.solve(equations, output_var)
-    return sol
+    index = {unknown: i for i, unknown in enumerate(system_unknowns)}
 
-def find_transfer_function(input_var, output_var):
-    input_sym = sp.symbols(input_var)
-    output_sym = sp.symbols(output_var)
+    A_entries = {}
+    b_entries = {}
+
+    for row, entry in excitations.items():
+        if row in index.keys():
+            b_entries[index[row]] = entry
+
+    for (row, column), entry in stamps.items():
+        if row not in index.keys():
+            continue
+
+        if column in fixed_voltages.keys():
+            # A term multiplying a fixed node voltage is known,
+            # so it moves to the right hand side
+            value, _ = fixed_voltages[column]
+            term = -1 * entry * value
+
+            if index[row] in b_entries.keys():
+                b_entries[index[row]] += term
+            else:
+                b_entries[index[row]] = term
+
+        elif column in index.keys():
+            A_entries[(index[row], index[column])] = entry
+
+    return A_entries, b_entries
+
+def build_MNA_system():
+    A_entries, b_entries = MNA_entries()
+
+    A = se.zeros(len(system_unknowns), len(system_unknowns))
+    b = se.zeros(len(system_unknowns), 1)
+
+    for (row, column), entry in A_entries.items():
+        A[row, column] = entry
+
+    for row, entry in b_entries.items():
+        b[row, 0] = entry
+
+    return A, b
+
+def generate_equations(A, b):
+    for node, (value, _) in fixed_voltages.items():
+        equations.append(se.Eq(node, value))
+
+    x = se.Matrix(system_unknowns)
+
+    for lhs, rhs in zip(A * x, b):
+        equations.append(se.Eq(lhs, rhs))
+
+def solve_equations(A, b):
+    # Fraction-free Gauss-Jordan elimination pivots past the zero
+    # diagonal entries of voltage source rows and avoids nesting
+    # fractions in the symbolic result
+    x = A.solve(b, method="FFGJ")
+    sols = dict(zip(system_unknowns, x))
+
+    for node, (value, _) in fixed_voltages.items():
+        sols[node] = value
+
+    sols.update(folded_source_currents(sols))
+
+    return {unknown: sols[unknown] for unknown in unknowns}
+
+def folded_source_currents(sols):
+    # The current of a folded voltage source is whatever balances
+    # the KCL equation of the node it fixes. sols maps every node
+    # voltage and unfolded source current to its value.
+    currents = {}
+
+    for node, (_, Vsrc_current) in fixed_voltages.items():
+        other_currents = [entry * sols[column]
+                          for (row, column), entry in stamps.items()
+                          if row == node and column != Vsrc_current]
+
+        currents[Vsrc_current] = (excitations.get(node, se.S.Zero) - se.Add(*other_currents)) \
+                                 / stamps[(node, Vsrc_current)]
+
+    return currents
+
+def frequency_response(frequencies, values, input_var, output_var):
+    # Evaluates the transfer function at each frequency (Hz) by solving
+    # the MNA system numerically with the components set to values,
+    # without ever solving it symbolically
+
+    # SciPy is only needed here, and importing it is slow,
+    # so it is kept out of the start up time of other runs
+    import scipy.sparse
+    import scipy.sparse.linalg
+
+    A_entries, b_entries = MNA_entries()
+
+    # The entries are lambdified in terms of s and the component
+    # symbols, and the component values are passed in when they are
+    # evaluated, rather than substituting every value into every entry
+    laplace_var = sp.symbols("s")
+    component_syms = [sp.symbols(name) for name in values.keys()]
+    component_values = tuple(values.values())
+    arguments = [laplace_var] + component_syms
+
+    # The sparsity pattern of A is fixed by the netlist, so only
+    # the values of its nonzero entries change with frequency
+    rows = [row for row, _ in A_entries.keys()]
+    columns = [column for _, column in A_entries.keys()]
+    A_values = [to_sympy(entry) for entry in A_entries.values()]
+
+    b_rows = list(b_entries.keys())
+    b_values = [to_sympy(entry) for entry in b_entries.values()]
+
+    numeric_A_entries = sp.lambdify(arguments, A_values, modules="numpy")
+    numeric_b_entries = sp.lambdify(arguments, b_values, modules="numpy")
+
+    index = {unknown: i for i, unknown in enumerate(system_unknowns)}
+
+    # The folded source currents in terms of the solved unknowns
+    known_voltages = {unknown: unknown for unknown in system_unknowns}
+    known_voltages.update({node: value for node, (value, _) in fixed_voltages.items()})
+    folded_currents = folded_source_currents(known_voltages)
+
+    def numeric_unknown(var):
+        # Returns a function of the solution x and s giving the value
+        # of var, which may be any unknown of the unfolded system
+        unknown = se.symbols(var)
+
+        if unknown in fixed_voltages.keys():
+            # Fixed node voltages do not depend on frequency
+            fixed_value = complex(sp.lambdify(component_syms,
+                                              to_sympy(fixed_voltages[unknown][0]),
+                                              modules="numpy")(*component_values))
+            return lambda x, s_value: fixed_value
+
+        if unknown in folded_currents.keys():
+            current = sp.lambdify(arguments + [to_sympy(u) for u in system_unknowns],
+                                  to_sympy(folded_currents[unknown]),
+                                  modules="numpy")
+            return lambda x, s_value: current(s_value, *component_values, *x)
+
+        position = index[unknown]
+        return lambda x, s_value: x[position]
+
+    input_value = numeric_unknown(input_var)
+    output_value = numeric_unknown(output_var)
+
+    size = len(system_unknowns)
+    response = np.empty(len(frequencies), dtype=complex)
+
+    for i, frequency in enumerate(frequencies):
+        s_value = 2j * np.pi * frequency
+
+        A = scipy.sparse.csc_matrix((np.asarray(numeric_A_entries(s_value, *component_values),
+                                                dtype=complex),
+                                     (rows, columns)),
+                                    shape=(size, size))
+
+        b = np.zeros(size, dtype=complex)
+        b[b_rows] = numeric_b_entries(s_value, *component_values)
+
+        x = scipy.sparse.linalg.splu(A).solve(b)
+        response[i] = output_value(x, s_value) / input_value(x, s_value)
+
+    return response
+
+def to_sympy(expr):
+    # SymEngine has no pretty printer or lambdify, so expressions
+    # are converted to SymPy only for display and evaluation
+    return sp.sympify(expr)
+
+def find_transfer_function(sols, input_var, output_var):
+    input_sym = se.symbols(input_var)
+    output_sym = se.symbols(output_var)
 
     input_var_expression = sols[input_sym]
     output_var_expression = sols[output_sym]
 
     transfer_func = output_var_expression / input_var_expression
-    return transfer_func
+    return input_sym, output_sym, transfer_func
+
+def build_symbolic_tf(netlist_path, input_var, output_var):
+    # Returns the transfer function in terms of s and the component
+    # symbols, along with the netlist's component values. Netlists
+    # that only differ in their values share one symbolic solution.
+    lines = read_netlist(netlist_path).splitlines()
+
+    # Parsing is cheap and always done, so the values (and the
+    # circuit state) are those of this netlist even on a cache hit
+    load_netlist(lines)
+
+    transfer_func = _build_symbolic_tf(netlist_topology(lines), input_var, output_var)
+    return transfer_func, dict(values)
+
+@functools.lru_cache(maxsize=8)
+def _build_symbolic_tf(topology, input_var, output_var):
+    # Solves the circuit most recently loaded by load_netlist, whose
+    # topology is the cache key
+    A, b = build_MNA_system()
+    sols = solve_equations(A, b)
+
+    _, _, transfer_func = find_transfer_function(sols, input_var, output_var)
+    return to_sympy(transfer_func)
+
+def evaluate_tf(tf_expr, values):
+    # Returns a function of s which evaluates the transfer function
+    # with the components set to values, a dict mapping each
+    # component's name to its value
+    numeric_tf = lambdify_tf(tf_expr, tuple(values.keys()))
+    component_values = tuple(values.values())
+
+    # A transfer function that does not depend on s lambdifies to
+    # a function returning a scalar, so the result is broadcast to
+    # the shape of s_value
+    return lambda s_value: np.broadcast_to(numeric_tf(s_value, *component_values),
+                                           np.shape(s_value))
+
+@functools.lru_cache(maxsize=8)
+def lambdify_tf(tf_expr, component_names):
+    component_syms = [sp.symbols(name) for name in component_names]
+    return sp.lambdify([sp.symbols("s")] + component_syms, tf_expr,
+                       modules="numpy", cse=True)
+
+def show(expr):
+    # Expressions are only pretty printed for a human at a
+    # terminal, and printed on one line when piped elsewhere
+    if sys.stdout.isatty():
+        sp.pprint(expr)
+    else:
+        print(expr)
 
 def print_equations():
     print("EQUATIONS ============================================================")
     for eq in equations:
-        sp.pprint(eq)
+        show(to_sympy(eq))
     print()
 
 def print_sols(sols):
     print("SOLUTIONS ============================================================")
-    for sol in sols:
-        sp.pprint(sp.Eq(sol, sols[sol]))
+
+    # Subexpressions shared between the solutions are
+    # printed once and referred to by name (x0, x1, ...)
+    replacements, reduced = sp.cse([to_sympy(expression) for expression in sols.values()])
+
+    for symbol, subexpression in replacements:
+        show(sp.Eq(symbol, subexpression))
+
+    for sol, expression in zip(sols.keys(), reduced):
+        show(sp.Eq(to_sympy(sol), expression))
     print()
 
-def print_transfer_func(input_var, output_var, transfer_func):
+def print_transfer_func(input_sym, output_sym, transfer_func):
     print("TRANSFER FUNCTION ====================================================")
-    
-    input_sym = sp.symbols(input_var)
-    output_sym = sp.symbols(output_var)
 
-    sp.pprint(sp.Eq(output_sym / input_sym, transfer_func))
+    show(sp.Eq(to_sympy(output_sym / input_sym), to_sympy(transfer_func)))
+
+    print()
+
+def print_sweep(frequencies, response):
+    print("FREQUENCY SWEEP ======================================================")
+    print("frequency (Hz)    magnitude (dB)    phase (deg)")
+
+    magnitudes = 20 * np.log10(np.abs(response))
+    phases = np.degrees(np.angle(response))
+
+    for frequency, magnitude, phase in zip(frequencies, magnitudes, phases):
+        print(f"{frequency:<18.6g}{magnitude:<18.6g}{phase:.6g}")
 
     print()
 
@@ -243,23 +782,110 @@ def print_component_values():
     print()
 
 
-with open(filename) as netlist_file:
-    lines = netlist_file.readlines()
+def parse_sweep(sweep):
+    # A sweep is given as fmin,fmax,N where fmin and fmax
+    # may use the same suffixes as component values
+    try:
+        fmin, fmax, points = sweep.split(",")
+        fmin = parse_value(fmin)
+        fmax = parse_value(fmax)
+        points = int(points)
+    except ValueError:
+        fmin = None
+
+    if fmin is None or fmax is None or fmin <= 0 or fmax <= 0 or points < 1:
+        raise argparse.ArgumentTypeError("Could not interpret sweep " + sweep)
+
+    return np.logspace(np.log10(fmin), np.log10(fmax), points)
+
+def parse_freqs(freqs):
+    # Frequencies are given as f1,f2,... and may use
+    # the same suffixes as component values
+    frequencies = [parse_value(frequency) for frequency in freqs.split(",")]
+
+    if any(frequency is None or frequency <= 0 for frequency in frequencies):
+        raise argparse.ArgumentTypeError("Could not interpret frequencies " + freqs)
+
+    return np.array(frequencies)
+
+def parse_args(args):
+    parser = argparse.ArgumentParser(description="Find the transfer function of a SPICE netlist")
+    parser.add_argument("filename", help="SPICE netlist to analyze")
+    parser.add_argument("input_var", help="unknown used as the input, e.g. VN001")
+    parser.add_argument("output_var", help="unknown used as the output, e.g. VN002")
+
+    # --freqs skips the symbolic solution that --sweep evaluates,
+    # so only one of them can be given
+    frequency_options = parser.add_mutually_exclusive_group()
+    frequency_options.add_argument("--sweep", type=parse_sweep, metavar="fmin,fmax,N",
+                                   help="evaluate the transfer function at N logarithmically "
+                                        "spaced frequencies from fmin to fmax (Hz)")
+    frequency_options.add_argument("--freqs", type=parse_freqs, metavar="f1,f2,...",
+                                   help="skip the symbolic solution and solve the circuit "
+                                        "numerically at each of the given frequencies (Hz)")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="neither read nor write solved circuits in " + str(CACHE_DIR))
+    parser.add_argument("--quiet", action="store_true",
+                        help="only print the transfer function, on one line, "
+                             "and any frequency response")
+    return parser.parse_args(args)
+
+def main():
+    args = parse_args(sys.argv[1:])
+
+    if sys.stdout.isatty() and not args.quiet:
+        sp.init_printing()
+
+    filename = args.filename
+    input_var = args.input_var
+    output_var = args.output_var
+
+    netlist_text = read_netlist(filename)
+    digest = netlist_digest(netlist_text)
+
+    sols = None
+
+    if not args.no_cache:
+        sols = load_cached_circuit(digest)
+
+    if sols is None:
+        load_netlist(netlist_text.splitlines())
+    else:
+        load_values(netlist_text.splitlines())
 
-    for line in lines:
-        tokens = line.split(" ")
-        tokens = [token.strip() for token in tokens]
-        
-        handle_spice_line(tokens)
+    if not args.quiet:
+        print_component_values()
+
+    if args.freqs is not None:
+        response = frequency_response(args.freqs, values, input_var, output_var)
+        print_sweep(args.freqs, response)
+        return
+
+    if sols is None:
+        A, b = build_MNA_system()
 
-    print_component_values()
+        generate_equations(A, b)
+        sols = solve_equations(A, b)
 
-    generate_KCL_equations()
-    print_equations()
+        if not args.no_cache:
+            save_cached_circuit(digest, sols)
+
+    input_sym, output_sym, transfer_func = find_transfer_function(sols, input_var, output_var)
+
+    if args.quiet:
+        print(to_sympy(transfer_func))
+    else:
+        print_equations()
+        print_sols(sols)
+        print_transfer_func(input_sym, output_sym, transfer_func)
 
-    sols = solve_equations(unknowns)
-    print_sols(sols)
+    if args.sweep is not None:
+        # The whole sweep is a single vectorized evaluation
+        # of the lambdified transfer function
+        numeric_tf = evaluate_tf(to_sympy(transfer_func), values)
+        response = numeric_tf(2j * np.pi * args.sweep)
+        print_sweep(args.sweep, response)
 
-    transfer_func = find_transfer_function(input_var, output_var)
-    print_transfer_func(input_var, output_var, transfer_func)
 
+if __name__ == "__main__":
+    main()
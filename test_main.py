@@ -0,0 +1,200 @@
+## Tests for the netlist parsing, MNA solution and caching in main.py
+
+import numpy as np
+import pytest
+import symengine as se
+
+import main
+
+# A grounded source (V1), a floating source (V2), a source with its
+# negative node not grounded but its positive node grounded (V3),
+# and every other kind of component
+NETLIST = """* folding test
+V1 N1 0 1
+V2 N2 N1 2
+R1 N2 N3 1k
+C1 N3 0 1u
+V3 0 N4 3
+R2 N4 N3 2k
+L1 N3 N5 1m
+R3 N5 0 100
+I1 N5 0 1m
+.end
+"""
+
+FREQUENCY = 1000.0
+
+# The folding tests check that folding grounded voltage sources
+# gives the same solutions as the full MNA system
+
+
+def unfolded_solution(frequency):
+    # Solves the MNA system exactly as stamped, with every voltage
+    # source keeping its current unknown and constraint row
+    substitutions = {se.symbols(name): value for name, value in main.values.items()}
+    substitutions[main.s] = 2j * np.pi * frequency
+
+    size = len(main.unknowns)
+    A = np.zeros((size, size), dtype=complex)
+    b = np.zeros(size, dtype=complex)
+
+    for (row, column), entry in main.stamps.items():
+        A[main.unknown_index[row], main.unknown_index[column]] = complex(entry.subs(substitutions))
+
+    for row, entry in main.excitations.items():
+        b[main.unknown_index[row]] = complex(entry.subs(substitutions))
+
+    x = np.linalg.solve(A, b)
+    return {str(unknown): x[i] for i, unknown in enumerate(main.unknowns)}
+
+
+@pytest.fixture
+def circuit():
+    main.load_netlist(NETLIST.splitlines())
+    return unfolded_solution(FREQUENCY)
+
+
+def test_grounded_sources_are_folded(circuit):
+    main.build_MNA_system()
+
+    fixed = {str(node) for node in main.fixed_voltages.keys()}
+    assert fixed == {"VN1", "VN4"}
+    assert [str(unknown) for unknown in main.system_unknowns] == ["VN2", "IV2", "VN3", "VN5"]
+
+
+def test_reset_circuit_clears_folding(circuit):
+    main.build_MNA_system()
+    main.reset_circuit()
+
+    assert main.fixed_voltages == {}
+    assert main.system_unknowns == []
+
+
+def test_symbolic_solution_matches_unfolded_system(circuit):
+    A, b = main.build_MNA_system()
+    sols = main.solve_equations(A, b)
+
+    substitutions = {se.symbols(name): value for name, value in main.values.items()}
+    substitutions[main.s] = 2j * np.pi * FREQUENCY
+
+    assert [str(unknown) for unknown in sols.keys()] == list(circuit.keys())
+
+    for unknown, expression in sols.items():
+        assert complex(expression.subs(substitutions)) == pytest.approx(circuit[str(unknown)])
+
+
+@pytest.mark.parametrize("output_var", ["VN5", "IV1", "IV2", "IV3"])
+def test_frequency_response_matches_unfolded_system(circuit, output_var):
+    response = main.frequency_response([FREQUENCY], main.values, "VN1", output_var)
+
+    assert response[0] == pytest.approx(circuit[output_var] / circuit["VN1"])
+
+
+@pytest.mark.parametrize("value, expected", [("1f", 1e-15),
+                                             ("10uF", 10e-6),
+                                             ("1mil", 25.4e-6),
+                                             ("1meg", 1e6),
+                                             (".5p", 0.5e-12),
+                                             ("1µH", 1e-6),
+                                             ("1.5k", 1500.0),
+                                             ("1e-3", 1e-3)])
+def test_parse_value(value, expected):
+    # SPICE suffixes are case insensitive, so a trailing F is
+    # femto rather than farads
+    assert main.parse_value(value) == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("value", ["1Megohm", "abc", "1.2.3"])
+def test_parse_value_rejects(value):
+    assert main.parse_value(value) is None
+
+
+def write_divider(tmp_path, name, R1, R2):
+    netlist_path = tmp_path / name
+    netlist_path.write_text("V1 in 0 1\n"
+                            "R1 in out " + R1 + "\n"
+                            "R2 out 0 " + R2 + "\n")
+    return netlist_path
+
+
+def test_build_symbolic_tf_returns_each_netlists_values(tmp_path):
+    first = write_divider(tmp_path, "first.net", "1k", "1k")
+    second = write_divider(tmp_path, "second.net", "1k", "3k")
+
+    first_tf, first_values = main.build_symbolic_tf(first, "Vin", "Vout")
+    second_tf, second_values = main.build_symbolic_tf(second, "Vin", "Vout")
+    again_tf, again_values = main.build_symbolic_tf(first, "Vin", "Vout")
+
+    # Both netlists have the same topology, so they share one solution
+    assert second_tf is first_tf
+    assert again_tf is first_tf
+
+    s_values = 2j * np.pi * np.array([1.0, 1e3])
+
+    assert main.evaluate_tf(first_tf, first_values)(s_values) == pytest.approx([0.5, 0.5])
+    assert main.evaluate_tf(second_tf, second_values)(s_values) == pytest.approx([0.75, 0.75])
+    assert main.evaluate_tf(again_tf, again_values)(s_values) == pytest.approx([0.5, 0.5])
+
+
+def test_netlist_digest_ignores_values():
+    first = "V1 in 0 1\nR1 in out 1k\nR2 out 0 1k\n"
+    second = "V1 in 0 1\nR1 in out 1k\nR2 out 0 3k\n"
+    rewired = "V1 in 0 1\nR1 in out 1k\nR2 in 0 1k\n"
+
+    assert main.netlist_digest(first) == main.netlist_digest(second)
+    assert main.netlist_digest(first) != main.netlist_digest(rewired)
+
+
+def test_parallel_stamping_matches_serial(monkeypatch):
+    main.load_netlist(NETLIST.splitlines())
+    serial = (dict(main.stamps), dict(main.excitations), list(main.unknowns),
+              dict(main.values), dict(main.voltage_sources))
+
+    # Three lines per chunk splits the netlist across several
+    # tasks, with components sharing nodes in different chunks
+    monkeypatch.setattr(main, "STAMP_CHUNK_SIZE", 3)
+    monkeypatch.setattr(main, "available_cpus", lambda: 2)
+
+    main.load_netlist(NETLIST.splitlines())
+    parallel = (main.stamps, main.excitations, main.unknowns,
+                main.values, main.voltage_sources)
+
+    assert parallel == serial
+
+
+def test_cache(circuit, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "CACHE_DIR", tmp_path / "cache")
+
+    A, b = main.build_MNA_system()
+    sols = main.solve_equations(A, b)
+    digest = main.netlist_digest(NETLIST)
+
+    assert main.load_cached_circuit(digest) is None
+
+    main.save_cached_circuit(digest, sols)
+    assert main.load_cached_circuit(digest) == sols
+    assert [path.name for path in (tmp_path / "cache").iterdir()] == [digest + ".pkl"]
+
+    # A corrupt entry is a cache miss
+    (tmp_path / "cache" / (digest + ".pkl")).write_bytes(b"not a pickle")
+    assert main.load_cached_circuit(digest) is None
+
+    # A cache directory that cannot be created (here because a file
+    # is in the way) leaves the circuit uncached instead of failing
+    (tmp_path / "file").write_text("")
+    monkeypatch.setattr(main, "CACHE_DIR", tmp_path / "file" / "cache")
+
+    main.save_cached_circuit(digest, sols)
+    assert main.load_cached_circuit(digest) is None
+
+
+def test_failed_cache_write_leaves_no_temporary_file(circuit, tmp_path, monkeypatch):
+    monkeypatch.setattr(main, "CACHE_DIR", tmp_path)
+
+    def fail_replace(source, destination):
+        raise OSError("replace failed")
+
+    monkeypatch.setattr(main.os, "replace", fail_replace)
+
+    main.save_cached_circuit(main.netlist_digest(NETLIST), {})
+    assert list(tmp_path.iterdir()) == []